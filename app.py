@@ -1,35 +1,315 @@
 # app.py
 import os
+import numpy as np
 import pandas as pd
-from flask import Flask, render_template, request, redirect, url_for
+import pyarrow.csv as pacsv # Multi-threaded CSV parser
+from flask import Flask, render_template, request, redirect, url_for, Response, stream_with_context, jsonify
+import json
+from flask_caching import Cache # Caches assembled search results
+from flask_compress import Compress # gzip/brotli responses, mostly the rendered page with its location data
 from dotenv import load_dotenv
 import sys # Import sys for exiting
+from functools import reduce
+import asyncio # Drive the Mapbox route requests concurrently
+import threading # Background thread running the shared event loop
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import aiohttp # Async HTTP client for the Mapbox Directions API
+import diskcache # Persistent cache for Mapbox route results
+from rapidfuzz import fuzz, process # Fuzzy matching for misspelled disease names
 import polyline # Import polyline to decode the route path if needed server-side (though we'll decode in JS)
 
-# Import Mapbox specific libraries
-from mapbox import Directions # The Directions API client
-import mapbox.errors # The errors module to catch API exceptions
-
 # Load environment variables from .env file
 load_dotenv()
 
+# --- Logging ---
+# Records go through a queue and are written to stderr by a background listener thread,
+# so request handlers never block on console I/O.
+# LOG_LEVEL=DEBUG shows per-request/per-location details; keep it at INFO or above in production.
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+    handlers=[QueueHandler(log_queue)]
+)
+log_listener.start()
+atexit.register(log_listener.stop) # Flushes queued records on exit
+logger = logging.getLogger(__name__)
+
 # --- Configuration ---
 MAPBOX_TOKEN = os.getenv('MAPBOX_TOKEN')
 if not MAPBOX_TOKEN or MAPBOX_TOKEN == "YOUR_MAPBOX_ACCESS_TOKEN":
-    print("Error: MAPBOX_TOKEN not found or is placeholder in .env file.")
-    print("Please create/update a .env file in the same directory as app.py and add MAPBOX_TOKEN=YOUR_MAPBOX_ACCESS_TOKEN")
-    print("Exiting.")
+    logger.error("MAPBOX_TOKEN not found or is placeholder in .env file.")
+    logger.error("Please create/update a .env file in the same directory as app.py and add MAPBOX_TOKEN=YOUR_MAPBOX_ACCESS_TOKEN")
+    logger.error("Exiting.")
     sys.exit(1) # Use sys.exit to stop the script
 
-# --- Initialize Mapbox Directions Client ---
-try:
-    directions_client = Directions(access_token=MAPBOX_TOKEN)
-    print("Mapbox Directions Client initialized.")
-except Exception as e:
-    # Catch broader exceptions during client initialization if needed
-    print(f"Error initializing Mapbox Client. Check your Access Token or network connection: {e}")
-    print("Exiting.")
-    sys.exit(1)
+# --- Mapbox Directions / Matrix APIs ---
+# Routes are fetched concurrently with aiohttp; one semaphore caps the process's in-flight requests
+MAPBOX_DIRECTIONS_URL = "https://api.mapbox.com/directions/v5/mapbox/driving/{u_lon},{u_lat};{d_lon},{d_lat}"
+MAPBOX_MATRIX_URL = "https://api.mapbox.com/directions-matrix/v1/mapbox/driving/{coordinates}"
+MAX_CONCURRENT_ROUTE_REQUESTS = 10
+MATRIX_MAX_DESTINATIONS = 24 # Matrix API allows 25 coordinates per request, one of which is the user
+
+# --- Route Cache ---
+# Routes barely change over a day, so cache them on disk (shared across worker processes).
+# User coordinates are rounded to ~100m so nearby searches reuse the same entries.
+ROUTE_CACHE_DIR = '.routecache'
+ROUTE_CACHE_EXPIRE_SECONDS = 86400
+USER_COORD_PRECISION = 3
+DOCTOR_COORD_PRECISION = 5 # ~1m: doctors this close together are treated as the same destination
+route_cache = diskcache.Cache(ROUTE_CACHE_DIR)
+
+
+def route_cache_key(kind, user_lonlat, doc_lonlat):
+    """Build the cache key for a 'travel' or 'route' result between the user cell and a doctor."""
+    u_lon, u_lat = user_lonlat
+    d_lon, d_lat = doc_lonlat
+    return (kind, round(float(u_lat), USER_COORD_PRECISION), round(float(u_lon), USER_COORD_PRECISION), float(d_lat), float(d_lon))
+
+
+# --- Shared HTTP Session ---
+# All Mapbox requests run on one background event loop and reuse one aiohttp session, so connections
+# (DNS lookups and TLS handshakes) are kept alive across searches instead of being set up per request.
+# Both are created lazily, after gunicorn has forked its workers.
+HTTP_CONNECTION_LIMIT = 64
+HTTP_DNS_CACHE_SECONDS = 300
+HTTP_TIMEOUT_SECONDS = 10
+route_loop = None
+route_loop_lock = threading.Lock()
+http_session = None
+mapbox_semaphore = None
+
+
+def get_route_loop():
+    """Return the background event loop for Mapbox requests, starting it on first use."""
+    global route_loop
+    with route_loop_lock:
+        if route_loop is None:
+            route_loop = asyncio.new_event_loop()
+            threading.Thread(target=route_loop.run_forever, name='mapbox-routes', daemon=True).start()
+        return route_loop
+
+
+async def get_session():
+    """Return the process-wide aiohttp session (must be awaited on the route loop)."""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_CONNECTION_LIMIT, ttl_dns_cache=HTTP_DNS_CACHE_SECONDS),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT_SECONDS)
+        )
+    return http_session
+
+
+async def get_mapbox_semaphore():
+    """Return the semaphore shared by all Mapbox requests in this process (must be awaited on the route loop)."""
+    global mapbox_semaphore
+    if mapbox_semaphore is None:
+        mapbox_semaphore = asyncio.Semaphore(MAX_CONCURRENT_ROUTE_REQUESTS)
+    return mapbox_semaphore
+
+
+@atexit.register
+def close_session():
+    """Close the shared aiohttp session on shutdown so its connections are released cleanly."""
+    if route_loop is not None and http_session is not None and not http_session.closed:
+        asyncio.run_coroutine_threadsafe(http_session.close(), route_loop).result(timeout=HTTP_TIMEOUT_SECONDS)
+
+
+class MapboxAPIError(Exception):
+    """Raised when the Mapbox Directions API returns an error code."""
+
+
+async def fetch_route(session, sem, user_lonlat, doc_lonlat):
+    """Fetch the driving route between two [lon, lat] points.
+
+    Returns a (duration_seconds, distance_meters, geometry) tuple, or None if
+    Mapbox found no route. Raises MapboxAPIError for API error responses.
+    """
+    u_lon, u_lat = user_lonlat
+    d_lon, d_lat = doc_lonlat
+    url = MAPBOX_DIRECTIONS_URL.format(u_lon=u_lon, u_lat=u_lat, d_lon=d_lon, d_lat=d_lat)
+    params = {
+        'geometries': 'polyline', # Request encoded polyline
+        'overview': 'simplified', # Request simplified overview geometry
+        'access_token': MAPBOX_TOKEN,
+    }
+    async with sem:
+        async with session.get(url, params=params) as response:
+            directions_result = await response.json(content_type=None)
+            if response.status >= 400:
+                raise MapboxAPIError(directions_result.get('message', f"HTTP {response.status}"))
+
+    if directions_result and directions_result.get('routes'):
+        route = directions_result['routes'][0] # Get the first route
+        return route.get('duration'), route.get('distance'), route.get('geometry')
+    if directions_result and directions_result.get('code') != 'Ok':
+        error_code = directions_result.get('code', 'Unknown API Error')
+        error_message_detail = directions_result.get('message', '')
+        raise MapboxAPIError(f"{error_code} - {error_message_detail}" if error_message_detail else error_code)
+    return None
+
+
+async def fetch_matrix(session, sem, user_lonlat, doc_lonlats):
+    """Fetch driving durations/distances from the user to up to MATRIX_MAX_DESTINATIONS doctors.
+
+    Returns a list of (duration_seconds, distance_meters) tuples in the same
+    order as doc_lonlats, with None for unreachable destinations.
+    Raises MapboxAPIError for API error responses.
+    """
+    coordinates = ';'.join(f"{lon},{lat}" for lon, lat in [user_lonlat, *doc_lonlats])
+    params = {
+        'sources': '0', # The user is always the first coordinate
+        'destinations': ';'.join(str(i) for i in range(1, len(doc_lonlats) + 1)),
+        'annotations': 'duration,distance',
+        'access_token': MAPBOX_TOKEN,
+    }
+    async with sem:
+        async with session.get(MAPBOX_MATRIX_URL.format(coordinates=coordinates), params=params) as response:
+            matrix_result = await response.json(content_type=None)
+            if response.status >= 400:
+                raise MapboxAPIError(matrix_result.get('message', f"HTTP {response.status}"))
+
+    if matrix_result.get('code') != 'Ok':
+        error_code = matrix_result.get('code', 'Unknown API Error')
+        error_message_detail = matrix_result.get('message', '')
+        raise MapboxAPIError(f"{error_code} - {error_message_detail}" if error_message_detail else error_code)
+
+    durations = matrix_result.get('durations', [[]])[0]
+    distances = matrix_result.get('distances', [[]])[0]
+    return [
+        (duration, distance) if duration is not None else None
+        for duration, distance in zip(durations, distances)
+    ]
+
+
+async def iter_routes(user_lonlat, doc_lonlats):
+    """Yield (index, route_result) pairs for the doctors in doc_lonlats as soon as each is known.
+
+    Durations and distances come from batched Matrix API calls. Route geometry
+    is not included; the client fetches it from /geometry when a marker is
+    opened. Failed requests are yielded as the exception instead of raising.
+    """
+    sem = await get_mapbox_semaphore()
+    session = await get_session()
+
+    async def fetch_chunk(chunk):
+        try:
+            return chunk, await fetch_matrix(session, sem, user_lonlat, [doc_lonlats[i] for i in chunk])
+        except Exception as e:
+            return chunk, e
+
+    chunks = [
+        list(range(start, min(start + MATRIX_MAX_DESTINATIONS, len(doc_lonlats))))
+        for start in range(0, len(doc_lonlats), MATRIX_MAX_DESTINATIONS)
+    ]
+    for next_chunk in asyncio.as_completed([fetch_chunk(chunk) for chunk in chunks]):
+        chunk, chunk_result = await next_chunk
+        for position, i in enumerate(chunk):
+            yield i, chunk_result if isinstance(chunk_result, Exception) else chunk_result[position]
+
+
+async def fetch_single_route(user_lonlat, doc_lonlat):
+    """fetch_route with the shared session and semaphore, for running on the route loop."""
+    return await fetch_route(await get_session(), await get_mapbox_semaphore(), user_lonlat, doc_lonlat)
+
+
+def iterate_async(async_generator):
+    """Drive an async generator on the shared route loop from synchronous code (e.g. a Flask streaming response)."""
+    loop = get_route_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(async_generator.__anext__(), loop).result()
+            except StopAsyncIteration:
+                break
+    finally:
+        # Also runs if the client disconnects mid-stream, so the generator is finalized on its own loop
+        asyncio.run_coroutine_threadsafe(async_generator.aclose(), loop).result()
+
+
+# The route cache is read and written from the request thread, never on the shared route loop:
+# its disk I/O would otherwise stall the Mapbox requests of every other stream.
+
+def iter_cached_routes(user_lonlat, doc_lonlats):
+    """iter_routes served from the route cache where possible; cached travel times are yielded first."""
+    keys = [route_cache_key('travel', user_lonlat, doc_lonlat) for doc_lonlat in doc_lonlats]
+    uncached = []
+    for i, key in enumerate(keys):
+        route_result = route_cache.get(key)
+        if route_result is None:
+            uncached.append(i)
+        else:
+            yield i, route_result
+
+    # Only send doctors without a cached travel time to the Matrix API
+    uncached_routes = iter_routes(user_lonlat, [doc_lonlats[i] for i in uncached])
+    for position, route_result in iterate_async(uncached_routes):
+        i = uncached[position]
+        if isinstance(route_result, tuple):
+            route_cache.set(keys[i], route_result, expire=ROUTE_CACHE_EXPIRE_SECONDS)
+        yield i, route_result
+
+
+def get_route_geometry(user_lonlat, doc_lonlat):
+    """The encoded route polyline between two [lon, lat] points, from the route cache or the Directions API."""
+    key = route_cache_key('route', user_lonlat, doc_lonlat)
+    route_result = route_cache.get(key)
+    if route_result is None:
+        route_result = asyncio.run_coroutine_threadsafe(
+            fetch_single_route(user_lonlat, doc_lonlat), get_route_loop()
+        ).result()
+        if route_result is not None:
+            route_cache.set(key, route_result, expire=ROUTE_CACHE_EXPIRE_SECONDS)
+    return route_result[2] if route_result else None
+
+
+# Fields of a location dict sent to the client as a streamed route update
+ROUTE_FIELDS = ('id', 'travel_time_text', 'travel_distance_text')
+
+
+def format_route(route_result, location_info):
+    """Fill the travel time/distance fields of location_info from an iter_routes result."""
+    if isinstance(route_result, MapboxAPIError):
+        logger.debug("Mapbox API Error getting route for (%s, %s): %s", location_info['lat'], location_info['lon'], route_result)
+        location_info['travel_time_text'] = f"API Error: {route_result}"
+        location_info['travel_distance_text'] = f"API Error: {route_result}"
+        return
+    if isinstance(route_result, Exception):
+        logger.debug("An unexpected error occurred getting route for (%s, %s): %s", location_info['lat'], location_info['lon'], route_result)
+        location_info['travel_time_text'] = f"Error: {route_result}"
+        location_info['travel_distance_text'] = f"Error: {route_result}"
+        return
+    if route_result is None:
+        logger.debug("No route found by Mapbox for (%s, %s).", location_info['lat'], location_info['lon'])
+        location_info['travel_time_text'] = "Route not found"
+        location_info['travel_distance_text'] = "Route not found"
+        return
+
+    duration_seconds, distance_meters = route_result
+
+    # Format time
+    if duration_seconds is not None:
+        minutes = int(duration_seconds // 60)
+        hours = minutes // 60
+        remaining_minutes = minutes % 60
+        if hours > 0:
+            location_info['travel_time_text'] = f"{hours} hr {remaining_minutes} min (driving)"
+        else:
+            location_info['travel_time_text'] = f"{minutes} min (driving)"
+    else:
+        location_info['travel_time_text'] = "Time N/A"
+
+    # Format distance
+    if distance_meters is not None:
+        distance_km = distance_meters / 1000
+        location_info['travel_distance_text'] = f"{distance_km:.2f} km (driving)"
+    else:
+        location_info['travel_distance_text'] = "Distance N/A"
 
 
 # --- CSV Configuration ---
@@ -49,53 +329,287 @@ csv_data_df = pd.DataFrame() # Initialize an empty DataFrame
 data_load_success = False # Flag to indicate if data loaded ok
 
 try:
-    print(f"Attempting to load data from {csv_file_path}")
-    df = pd.read_csv(csv_file_path)
-    print(f"Successfully loaded data from {csv_file_path}. Initial rows: {len(df)}")
+    logger.info("Attempting to load data from %s", csv_file_path)
+
+    # Read just the header (and first block) to find out which columns the CSV has
+    with pacsv.open_csv(csv_file_path) as csv_reader:
+        csv_columns = csv_reader.schema.names
 
     # Validate columns
     required_columns = [latitude_column, longitude_column, disease_column]
     optional_columns_check = {name_column, details_column} # Use a set for faster lookup
 
-    missing_required_columns = [col for col in required_columns if col not in df.columns]
+    missing_required_columns = [col for col in required_columns if col not in csv_columns]
     if missing_required_columns:
-        print(f"Error: Missing required columns in the CSV: {missing_required_columns}")
-        print(f"Available columns are: {df.columns.tolist()}")
-        print("Exiting.")
+        logger.error("Missing required columns in the CSV: %s", missing_required_columns)
+        logger.error("Available columns are: %s", csv_columns)
+        logger.error("Exiting.")
         sys.exit(1)
 
+    # Only the required and available optional columns are parsed, with Arrow's multi-threaded reader;
+    # empty/"NA"/"N/A" text cells become nulls (NaN in pandas) like pd.read_csv
+    used_columns = required_columns + [col for col in csv_columns if col in optional_columns_check]
+    df = pacsv.read_csv(
+        csv_file_path,
+        convert_options=pacsv.ConvertOptions(include_columns=used_columns, strings_can_be_null=True)
+    ).to_pandas()
+    logger.info("Successfully loaded data from %s. Initial rows: %d", csv_file_path, len(df))
+
     # Data Cleaning: Convert lat/lon to numeric, drop rows with invalid coordinates
-    print("Cleaning data...")
+    logger.info("Cleaning data...")
     df[latitude_column] = pd.to_numeric(df[latitude_column], errors='coerce')
     df[longitude_column] = pd.to_numeric(df[longitude_column], errors='coerce')
     initial_rows = len(df)
     df.dropna(subset=[latitude_column, longitude_column], inplace=True)
     if len(df) < initial_rows:
-        print(f"Removed {initial_rows - len(df)} rows due to invalid LAT/LON data.")
+        logger.warning("Removed %d rows due to invalid LAT/LON data.", initial_rows - len(df))
 
     # Data Cleaning: Handle potential NaN in disease column for filtering
     df[disease_column] = df[disease_column].fillna('').astype(str)
 
     # Store the cleaned DataFrame globally
-    csv_data_df = df.copy() # Use .copy() to avoid potential issues later
-    print(f"Data preprocessing complete. Usable rows: {len(csv_data_df)}")
+    csv_data_df = df # No copy needed: df is not used again after this point
+    logger.info("Data preprocessing complete. Usable rows: %d", len(csv_data_df))
     data_load_success = True
 
 except FileNotFoundError:
-    print(f"Error: The CSV file was not found at {csv_file_path}")
-    print("Exiting.")
+    logger.error("The CSV file was not found at %s", csv_file_path)
+    logger.error("Exiting.")
     sys.exit(1)
 except Exception as e:
-    print(f"An error occurred while loading or processing the CSV file: {e}")
-    print("Exiting.")
+    logger.error("An error occurred while loading or processing the CSV file: %s", e)
+    logger.error("Exiting.")
     sys.exit(1)
 
 if not data_load_success or csv_data_df.empty:
-    print("Warning: No valid data points found in the CSV or data loading failed.")
+    logger.warning("No valid data points found in the CSV or data loading failed.")
     # We don't exit here, but the app won't show map markers
 
 
+# --- Column Arrays ---
+# The request handler only reads a handful of columns, so keep each one as a plain NumPy array
+# and work with integer row positions instead of DataFrame rows.
+def column_array(column, dtype=object):
+    """Return a column of csv_data_df as a NumPy array, or all-NaN if the (optional) column is missing."""
+    if column not in csv_data_df.columns:
+        return np.full(len(csv_data_df), np.nan, dtype=dtype)
+    return csv_data_df[column].to_numpy(dtype=dtype)
+
+
+LAT_ARR = column_array(latitude_column, np.float64)
+LON_ARR = column_array(longitude_column, np.float64)
+DISEASE_ARR = column_array(disease_column) # Full text from CSV, for display
+# Lowercased once, as a fixed-width string array so substring searches run inside NumPy's C string routines
+DISEASE_LOWER_ARR = np.char.lower(DISEASE_ARR.astype(np.str_))
+NAME_ARR = column_array(name_column)
+DETAILS_ARR = column_array(details_column)
+
+
+def location_info_for_row(row, travel_text):
+    """Build the template dict for one doctor, with travel_text as the initial time/distance placeholder."""
+    location_info = {
+        'lat': float(LAT_ARR[row]),
+        'lon': float(LON_ARR[row]),
+        'disease_info': DISEASE_ARR[row], # Full text from CSV
+        'travel_time_text': travel_text,
+        'travel_distance_text': travel_text,
+        'id': int(row) # Lets streamed route updates and route lines find their marker
+    }
+
+    # Add optional columns if they exist and are not NaN
+    if pd.notna(NAME_ARR[row]):
+        location_info['name'] = str(NAME_ARR[row])
+    if pd.notna(DETAILS_ARR[row]):
+        location_info['details'] = str(DETAILS_ARR[row])
+    return location_info
+
+
+# --- Disease Search Index ---
+# Map every 3-character substring of the lowercased disease text to the sorted row positions containing it.
+# A search only has to check rows that contain all of the needle's trigrams instead of scanning every row.
+TRIGRAM_SIZE = 3
+
+
+def disease_trigrams(text):
+    """Return the set of TRIGRAM_SIZE-character substrings of text."""
+    return {text[i:i + TRIGRAM_SIZE] for i in range(len(text) - TRIGRAM_SIZE + 1)}
+
+
+def build_trigram_index(disease_lower_values):
+    """Build the trigram -> sorted row positions index for the lowercased disease values."""
+    postings = {}
+    for position, disease in enumerate(disease_lower_values):
+        for trigram in disease_trigrams(disease):
+            postings.setdefault(trigram, []).append(position)
+    return {trigram: np.array(positions, dtype=np.intp) for trigram, positions in postings.items()}
+
+
+def find_matching_rows(search_disease_lower):
+    """Return the row positions whose disease text contains the (lowercased) search term."""
+    trigrams = disease_trigrams(search_disease_lower)
+    if trigrams:
+        postings = [disease_trigram_index.get(trigram) for trigram in trigrams]
+        if any(positions is None for positions in postings):
+            return np.array([], dtype=np.intp)
+        # Intersect smallest posting lists first to keep the candidate set small
+        candidates = reduce(np.intersect1d, sorted(postings, key=len))
+        # Sharing all trigrams doesn't guarantee a substring match, so confirm each candidate
+        return candidates[np.char.find(DISEASE_LOWER_ARR[candidates], search_disease_lower) >= 0]
+    # Search term shorter than a trigram: substring-search every row
+    return np.nonzero(np.char.find(DISEASE_LOWER_ARR, search_disease_lower) >= 0)[0]
+
+
+disease_trigram_index = build_trigram_index(DISEASE_LOWER_ARR)
+logger.info("Disease search index built with %d trigrams.", len(disease_trigram_index))
+
+
+# --- Fuzzy Fallback ---
+# Misspelled searches are matched against the distinct disease names only (far fewer than rows)
+FUZZY_MATCH_THRESHOLD = 85
+
+
+def best_fuzzy_match(choices, query, threshold=FUZZY_MATCH_THRESHOLD):
+    """Return the choice most similar to query, or None if nothing scores at least threshold."""
+    match = process.extractOne(query, choices, scorer=fuzz.ratio, score_cutoff=threshold)
+    return match[0] if match else None
+
+
+unique_diseases = [disease for disease in dict.fromkeys(d.strip() for d in DISEASE_LOWER_ARR) if disease]
+
+
+def search_rows(search_disease_lower):
+    """Row positions matching the search term, retrying with the closest known disease name if none do."""
+    # Look up matching rows (case-insensitive) through the disease trigram index
+    matching_rows = find_matching_rows(search_disease_lower)
+    if len(matching_rows) == 0:
+        # No direct match: retry with the closest known disease name in case of a typo
+        corrected_disease = best_fuzzy_match(unique_diseases, search_disease_lower)
+        if corrected_disease:
+            logger.debug("No matches for '%s', using closest disease '%s'.", search_disease_lower, corrected_disease)
+            matching_rows = find_matching_rows(corrected_disease)
+    return matching_rows
+
+
+# --- Nearest Doctor Lookup ---
+# Only the nearest matches within driving range are sent to Mapbox. The straight-line distances to the
+# matches are computed once and the nearest ones picked with np.argpartition, without sorting every row.
+ROUTE_MAX_CANDIDATES = 20
+MAX_ROUTE_DISTANCE_KM = 100 # Doctors farther than this in a straight line are never routed
+EARTH_RADIUS_KM = 6371
+TOO_FAR_TEXT = "Not calculated (too far)"
+NOT_NEAREST_TEXT = "Not calculated (not among the nearest)"
+REQUIRES_LOCATION_TEXT = "Requires Location"
+
+
+def great_circle_km(rows, user_lat, user_lon):
+    """Haversine distance in km from the user to each of the given rows."""
+    user_lat_rad = np.radians(user_lat)
+    dlat = lat_rad[rows] - user_lat_rad
+    dlon = lon_rad[rows] - np.radians(user_lon)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat_rad[rows]) * np.cos(user_lat_rad) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def route_candidate_rows(matching_rows, user_lat, user_lon, k=ROUTE_MAX_CANDIDATES, max_km=MAX_ROUTE_DISTANCE_KM):
+    """Pick the matching rows that get routed: up to k nearest within max_km.
+
+    Returns (rows, in_range): the picked rows, nearest to the user first, and
+    a mask over matching_rows of the ones within max_km.
+    """
+    distances = great_circle_km(matching_rows, user_lat, user_lon)
+    # Driving distance is never shorter than the straight line, so farther doctors are dropped outright
+    in_range = distances < max_km
+    rows, distances = matching_rows[in_range], distances[in_range]
+    if len(rows) > k:
+        nearest = np.argpartition(distances, k)[:k]
+        rows, distances = rows[nearest], distances[nearest]
+    return rows[np.argsort(distances, kind='stable')], in_range
+
+
+lat_rad = np.radians(LAT_ARR)
+lon_rad = np.radians(LON_ARR)
+
+
+# --- Initial Map View ---
+# The dataset doesn't change after startup, so the initial center/zoom are computed once here.
+# Default map center (can be based on your location or a general area)
+# Example: Your initial fixed location [lon, lat]
+DEFAULT_MAP_CENTER = [77.0267093, 11.0285484]
+DEFAULT_MAP_ZOOM = 12 # Default zoom level
+
+# If data loaded successfully, use a more sensible initial center/zoom based on the whole dataset
+if data_load_success and len(LAT_ARR) > 0:
+    DEFAULT_MAP_CENTER = [float(LON_ARR.mean()), float(LAT_ARR.mean())]
+    DEFAULT_MAP_ZOOM = 10 # Zoom out a bit initially
+logger.info("Initial map center: %s, zoom %s", DEFAULT_MAP_CENTER, DEFAULT_MAP_ZOOM)
+
+
+def parse_user_location(user_lat_str, user_lon_str):
+    """Parse the user's coordinates; returns (lat, lon), or None if either is missing, not a number or out of range."""
+    try:
+        user_lat, user_lon = float(user_lat_str), float(user_lon_str)
+    except (TypeError, ValueError):
+        return None
+    # NaN fails these comparisons too
+    if not (-90 <= user_lat <= 90 and -180 <= user_lon <= 180):
+        return None
+    return user_lat, user_lon
+
+
+def build_found_locations(search_disease_lower, user_lat, user_lon):
+    """Assemble the template locations for a search.
+
+    Returns (found_locations, routed_ids), where routed_ids are the ids of the
+    locations that get a travel time streamed from /routes.
+    """
+    matching_rows = search_rows(search_disease_lower)
+
+    # Prepare data for the template
+    # Routes aren't calculated here: the page renders right away and streams them from /routes
+    if len(matching_rows) == 0:
+        return [], []
+
+    # Only the nearest doctors within driving range get routed; the rest are still shown on the map.
+    # They're picked from the cached location cell so /routes streams exactly the rows marked here.
+    route_rows, in_range = route_candidate_rows(matching_rows, *search_cell(user_lat, user_lon))
+    route_rows = set(route_rows.tolist())
+    found_locations = [
+        location_info_for_row(row, NOT_NEAREST_TEXT if row_in_range else TOO_FAR_TEXT)
+        for row, row_in_range in zip(matching_rows, in_range)
+    ]
+    for location_info in found_locations:
+        if location_info['id'] in route_rows:
+            location_info['travel_time_text'] = "Calculating..." # Initial placeholder
+            location_info['travel_distance_text'] = "Calculating..."
+    return found_locations, sorted(route_rows)
+
+
+# --- Search Cache ---
+# The same disease searched from the same neighbourhood gives the same results, so cache them for an hour.
+# SimpleCache is per-process; set CACHE_TYPE=RedisCache and CACHE_REDIS_URL to share it between workers.
+SEARCH_CACHE_TIMEOUT_SECONDS = 3600
+SEARCH_COORD_PRECISION = 2 # ~1km cells
+
+
+def search_cell(user_lat, user_lon):
+    """The user's location rounded to the search cache cell."""
+    return round(user_lat, SEARCH_COORD_PRECISION), round(user_lon, SEARCH_COORD_PRECISION)
+
+
+def search_cache_key(search_disease_lower, user_lat, user_lon):
+    """Cache key for a search: the lowercased term plus the user's rounded location cell."""
+    cell_lat, cell_lon = search_cell(user_lat, user_lon)
+    return f"{search_disease_lower}|{cell_lat}|{cell_lon}"
+
+
 app = Flask(__name__)
+app.config.from_mapping(
+    CACHE_TYPE=os.getenv('CACHE_TYPE', 'SimpleCache'),
+    CACHE_REDIS_URL=os.getenv('CACHE_REDIS_URL'),
+    CACHE_DEFAULT_TIMEOUT=SEARCH_CACHE_TIMEOUT_SECONDS,
+)
+cache = Cache(app)
+Compress(app)
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -103,24 +617,12 @@ def index():
     search_disease = None
     user_lat = None
     user_lon = None
+    routes_url = None
+    routed_ids = []
 
-    # Default map center (can be based on your location or a general area)
-    # Example: Your initial fixed location [lon, lat]
-    # Adjust this to a suitable default if needed, perhaps the average of all points if data exists
-    map_center = [77.0267093, 11.0285484]
-    map_zoom = 12 # Default zoom level
-
-    # If data loaded successfully, calculate a more sensible initial center/zoom based on the whole dataset
-    if data_load_success and not csv_data_df.empty:
-        try:
-            avg_lat = csv_data_df[latitude_column].mean()
-            avg_lon = csv_data_df[longitude_column].mean()
-            map_center = [avg_lon, avg_lat]
-            map_zoom = 10 # Zoom out a bit initially
-        except Exception as e:
-            print(f"Could not calculate initial average center from CSV data: {e}")
-            # Fallback to hardcoded default center if calculation fails
-
+    # Initial map view, precomputed from the whole dataset at startup
+    map_center = DEFAULT_MAP_CENTER
+    map_zoom = DEFAULT_MAP_ZOOM
 
     if request.method == 'POST':
         search_disease = request.form.get('disease_name', '').strip() # Keep original case for display
@@ -129,152 +631,49 @@ def index():
         # Get user location from the form (sent via JavaScript)
         user_lat_str = request.form.get('user_lat')
         user_lon_str = request.form.get('user_lon')
-
-        try:
-            user_lat = float(user_lat_str) if user_lat_str else None
-            user_lon = float(user_lon_str) if user_lon_str else None
-            if user_lat is not None and user_lon is not None:
-                 print(f"Received user location: Lat={user_lat}, Lon={user_lon}")
-                 # If user location is available, center map on it after search
-                 map_center = [user_lon, user_lat] # Mapbox expects [lon, lat]
-                 map_zoom = 13 # Zoom in on user location
+        user_location = parse_user_location(user_lat_str, user_lon_str)
+
+        if user_location is None:
+            # Show the matches without travel times; the page resubmits the search if the browser
+            # provides the user's location later
+            logger.debug("User location missing or invalid: lat=%s, lon=%s", user_lat_str, user_lon_str)
+            if search_disease_lower and data_load_success and len(LAT_ARR) > 0:
+                matching_rows = search_rows(search_disease_lower)
+                found_locations = [location_info_for_row(row, REQUIRES_LOCATION_TEXT) for row in matching_rows]
+                if found_locations:
+                    map_center = [float(np.mean(LON_ARR[matching_rows])), float(np.mean(LAT_ARR[matching_rows]))] # [lon, lat]
+                    map_zoom = 13 # Zoom in a bit when specific locations are found
+            return render_template(
+                'index.html',
+                mapbox_token=MAPBOX_TOKEN,
+                locations=found_locations,
+                search_disease=search_disease,
+                map_center=map_center,
+                map_zoom=map_zoom,
+                user_lat=None,
+                user_lon=None,
+                routes_url=None,
+                routed_ids=[],
+                location_required=bool(found_locations) # Tells the page to resend the search with the user's location
+            )
+
+        user_lat, user_lon = user_location
+        logger.debug("Received user location: Lat=%s, Lon=%s", user_lat, user_lon)
+        # Center map on the user's location after search
+        map_center = [user_lon, user_lat] # Mapbox expects [lon, lat]
+        map_zoom = 13 # Zoom in on user location
+
+        if search_disease_lower and data_load_success and len(LAT_ARR) > 0:
+            # Repeat searches for the same disease from the same neighbourhood reuse the assembled results
+            search_key = 'search|' + search_cache_key(search_disease_lower, user_lat, user_lon)
+            cached_search = cache.get(search_key)
+            if cached_search is not None:
+                found_locations, routed_ids = cached_search
             else:
-                 print("User location not provided or invalid.")
-
-        except ValueError:
-            print(f"Invalid user location coordinates received: lat={user_lat_str}, lon={user_lon_str}")
-            user_lat = None
-            user_lon = None # Treat as not provided
-
-
-        if search_disease_lower and data_load_success and not csv_data_df.empty:
-            # Filter the preloaded DataFrame based on the disease column (case-insensitive)
-            filtered_df = csv_data_df[
-                csv_data_df[disease_column].str.contains(search_disease_lower, case=False, na=False, regex=False)
-            ].copy()
-
-            # Prepare data for the template
-            found_locations = []
-            if not filtered_df.empty:
-                # If user location is available, get routes, times, and distances
-                if user_lat is not None and user_lon is not None:
-                     user_location_mapbox = (user_lon, user_lat)
-                     print(f"Calculating routes from user location ({user_lat}, {user_lon})...")
-
-                     for index, row in filtered_df.iterrows():
-                         loc_lat = row[latitude_column]
-                         loc_lon = row[longitude_column]
-                         doctor_location_mapbox = (loc_lon, loc_lat)
-
-                         location_info = {
-                             'lat': loc_lat,
-                             'lon': loc_lon,
-                             'disease_info': row[disease_column], # Full text from CSV
-                             'travel_time_text': "Calculating...", # Initial placeholder
-                             'travel_distance_text': "Calculating...",
-                             'route_geometry_encoded': None # Will store Mapbox encoded polyline
-                         }
-
-                         # Add optional columns if they exist and are not NaN
-                         if name_column in row and pd.notna(row[name_column]):
-                              location_info['name'] = str(row[name_column])
-                         if details_column in row and pd.notna(row[details_column]):
-                              location_info['details'] = str(row[details_column])
-
-                         try:
-                             # Mapbox Directions API request
-                             # Use profile 'mapbox/driving' for car routes
-                             response = directions_client.directions(
-                                [user_location_mapbox, doctor_location_mapbox],
-                                profile='mapbox/driving', # Use the driving profile
-                                geometries='polyline', # Request encoded polyline
-                                overview='simplified' # Request simplified overview geometry
-                             )
-                             response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
-
-                             directions_result = response.json()
-
-                             if directions_result and directions_result.get('routes'):
-                                 route = directions_result['routes'][0] # Get the first route
-
-                                 duration_seconds = route.get('duration') # in seconds
-                                 distance_meters = route.get('distance') # in meters
-                                 route_geometry_encoded = route.get('geometry') # encoded polyline
-
-                                 # Format time
-                                 if duration_seconds is not None:
-                                     minutes = int(duration_seconds // 60)
-                                     hours = minutes // 60
-                                     remaining_minutes = minutes % 60
-                                     if hours > 0:
-                                         location_info['travel_time_text'] = f"{hours} hr {remaining_minutes} min (driving)"
-                                     else:
-                                         location_info['travel_time_text'] = f"{minutes} min (driving)"
-                                 else:
-                                     location_info['travel_time_text'] = "Time N/A"
-
-                                 # Format distance
-                                 if distance_meters is not None:
-                                     distance_km = distance_meters / 1000
-                                     location_info['travel_distance_text'] = f"{distance_km:.2f} km (driving)"
-                                 else:
-                                     location_info['travel_distance_text'] = "Distance N/A"
-
-                                 location_info['route_geometry_encoded'] = route_geometry_encoded # Store the encoded polyline
-
-                                 # print(f"  - Route calculated for ({loc_lat}, {loc_lon})") # Debug print
-
-                             elif directions_result and directions_result.get('code') != 'Ok':
-                                  error_code = directions_result.get('code', 'Unknown API Error')
-                                  error_message_detail = directions_result.get('message', '')
-                                  print(f"  - Mapbox API returned error code for ({loc_lat}, {loc_lon}): {error_code} - {error_message_detail}")
-                                  location_info['travel_time_text'] = f"API Error: {error_code}"
-                                  location_info['travel_distance_text'] = f"API Error: {error_code}"
-                             else:
-                                 print(f"  - No route found by Mapbox for ({loc_lat}, {loc_lon}).")
-                                 location_info['travel_time_text'] = "Route not found"
-                                 location_info['travel_distance_text'] = "Route not found"
-
-                         except mapbox.errors.MapboxAPIError as e:
-                             print(f"  - Mapbox API Error getting route for ({loc_lat}, {loc_lon}): {e}")
-                             location_info['travel_time_text'] = f"API Error: {e}"
-                             location_info['travel_distance_text'] = f"API Error: {e}"
-                         except Exception as e:
-                             print(f"  - An unexpected error occurred getting route for ({loc_lat}, {loc_lon}): {e}")
-                             location_info['travel_time_text'] = f"Error: {e}"
-                             location_info['travel_distance_text'] = f"Error: {e}"
-
-                         found_locations.append(location_info)
-
-                else: # User location not available, just pass basic location info
-                    print("User location not available. Skipping route calculations.")
-                    for index, row in filtered_df.iterrows():
-                         location_info = {
-                             'lat': row[latitude_column],
-                             'lon': row[longitude_column],
-                             'disease_info': row[disease_column],
-                             'travel_time_text': "Requires Location",
-                             'travel_distance_text': "Requires Location",
-                             'route_geometry_encoded': None
-                         }
-                         if name_column in row and pd.notna(row[name_column]):
-                              location_info['name'] = str(row[name_column])
-                         if details_column in row and pd.notna(row[details_column]):
-                              location_info['details'] = str(row[details_column])
-                         found_locations.append(location_info)
-
-
-            # Recalculate map center/zoom based on *found* locations if no user location was provided
-            # This helps center the map on the results if user location isn't used
-            if found_locations and (user_lat is None or user_lon is None):
-                try:
-                     avg_lat = sum(loc['lat'] for loc in found_locations) / len(found_locations)
-                     avg_lon = sum(loc['lon'] for loc in found_locations) / len(found_locations)
-                     map_center = [avg_lon, avg_lat] # Mapbox expects [lon, lat]
-                     map_zoom = 13 # Zoom in a bit when specific locations are found
-                except Exception as e:
-                     print(f"Could not calculate average center from found locations: {e}")
-                     # Fallback to default or user location if available
+                found_locations, routed_ids = build_found_locations(search_disease_lower, user_lat, user_lon)
+                cache.set(search_key, (found_locations, routed_ids))
+            if routed_ids:
+                routes_url = url_for('routes', disease=search_disease, lat=user_lat, lon=user_lon)
 
     # Pass the actual search term, user location status, and found locations to the template
     return render_template(
@@ -285,11 +684,109 @@ def index():
         map_center=map_center,
         map_zoom=map_zoom,
         user_lat=user_lat, # Pass user location to JS to add a marker
-        user_lon=user_lon
+        user_lon=user_lon,
+        routes_url=routes_url, # Server-sent events stream with the travel time for each routed location
+        routed_ids=routed_ids, # Only these locations get a route line when their marker is opened
+        location_required=False
     )
 
+
+@app.route('/routes')
+def routes():
+    """Stream travel time/distance updates for a search as server-sent events.
+
+    Each message is a JSON object with the location 'id' and its route fields;
+    a final 'done' event tells the client to close the connection.
+    """
+    search_disease_lower = request.args.get('disease', '').strip().lower()
+    user_location = parse_user_location(request.args.get('lat'), request.args.get('lon'))
+    if user_location is None:
+        return Response("Valid lat and lon query parameters are required", status=400)
+    user_lat, user_lon = user_location
+
+    # A finished stream for the same disease and neighbourhood is replayed instead of recalculated
+    routes_key = 'routes|' + search_cache_key(search_disease_lower, user_lat, user_lon)
+    cached_messages = cache.get(routes_key)
+    if cached_messages is not None:
+        return Response(cached_messages + ["event: done\ndata: {}\n\n"], mimetype='text/event-stream')
+
+    route_rows = []
+    if search_disease_lower and data_load_success and len(LAT_ARR) > 0:
+        # Same cell-based pick as build_found_locations, so every "Calculating..." marker gets an update
+        route_rows, _ = route_candidate_rows(search_rows(search_disease_lower), *search_cell(user_lat, user_lon))
+    logger.debug("Streaming routes for %d locations from user location (%s, %s)...", len(route_rows), user_lat, user_lon)
+
+    # Doctors at the same clinic share coordinates: route each distinct point once and copy the result
+    rows_by_point = {}
+    for row in route_rows:
+        point = (round(float(LAT_ARR[row]), DOCTOR_COORD_PRECISION), round(float(LON_ARR[row]), DOCTOR_COORD_PRECISION))
+        rows_by_point.setdefault(point, []).append(row)
+    points = list(rows_by_point)
+
+    def generate():
+        messages = []
+        all_routed = True
+        doc_lonlats = [(lon, lat) for lat, lon in points]
+        for i, route_result in iter_cached_routes((user_lon, user_lat), doc_lonlats):
+            all_routed = all_routed and isinstance(route_result, tuple)
+            point_rows = rows_by_point[points[i]]
+            location_info = location_info_for_row(point_rows[0], None)
+            format_route(route_result, location_info)
+            for row in point_rows:
+                route_update = {field: location_info[field] for field in ROUTE_FIELDS}
+                route_update['id'] = int(row)
+                message = f"data: {json.dumps(route_update)}\n\n"
+                messages.append(message)
+                yield message
+        # Only cache complete streams where every location was routed. Errors and missing routes are
+        # often transient (rate limits, timeouts), and a cached copy would show them to everyone
+        # searching from this cell for an hour instead of retrying.
+        if all_routed:
+            cache.set(routes_key, messages)
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+
+@app.route('/geometry/<int:location_id>')
+def geometry(location_id):
+    """Return the encoded driving route polyline from the user (lat/lon query parameters) to one location.
+
+    Route lines are only fetched when the user opens a marker, so the search
+    page doesn't carry a polyline for every result. Only locations that the
+    search for the 'disease' query parameter routes from this position are
+    served, so the endpoint can't be used to call Mapbox for arbitrary pairs.
+    """
+    search_disease_lower = request.args.get('disease', '').strip().lower()
+    user_location = parse_user_location(request.args.get('lat'), request.args.get('lon'))
+    if user_location is None:
+        return jsonify(error="Valid lat and lon query parameters are required"), 400
+    user_lat, user_lon = user_location
+    if not 0 <= location_id < len(LAT_ARR):
+        return jsonify(error="Unknown location"), 404
+
+    # Same pick as build_found_locations and /routes
+    route_rows = []
+    if search_disease_lower and data_load_success:
+        route_rows, _ = route_candidate_rows(search_rows(search_disease_lower), *search_cell(user_lat, user_lon))
+    if location_id not in route_rows:
+        return jsonify(error="Location is not routed for this search"), 404
+
+    doc_lonlat = (float(LON_ARR[location_id]), float(LAT_ARR[location_id]))
+    try:
+        route_geometry_encoded = get_route_geometry((user_lon, user_lat), doc_lonlat)
+    except MapboxAPIError as e:
+        logger.debug("Mapbox API Error getting route for (%s, %s): %s", doc_lonlat[1], doc_lonlat[0], e)
+        return jsonify(error=f"API Error: {e}"), 502
+    except Exception as e:
+        logger.debug("An unexpected error occurred getting route for (%s, %s): %s", doc_lonlat[1], doc_lonlat[0], e)
+        return jsonify(error=f"Error: {e}"), 502
+    return jsonify(id=location_id, route_geometry_encoded=route_geometry_encoded)
+
 if __name__ == '__main__':
     # Run the Flask app
     # debug=True is useful for development (auto-reloads on code changes)
+    # The dev server already handles each request in its own thread; in production the Procfile runs
+    # gunicorn with threaded workers, so one search waiting on Mapbox doesn't block the others
     # app.run(debug=True, port=8000) # Example running on port 8000
     app.run(debug=True) # Runs on default port 5000
\ No newline at end of file